@@ -2,7 +2,7 @@ import logging
 import time
 from pathlib import Path
 
-from bsky_gazo_bot.db import ImageDataset
+from bsky_gazo_bot.db import ImageDataset, InvalidImageException
 
 
 def add_images_manually(input_dir: Path, data_dir: Path, skip_register: bool, ext: str = "jpg") -> None:
@@ -13,7 +13,11 @@ def add_images_manually(input_dir: Path, data_dir: Path, skip_register: bool, ex
 
     for i, file in enumerate(input_dir.glob(f"*.{ext}")):
         file_id = f"{base_id}_{i:04}"
-        image_id = image_dataset.add_image_file(file_id=file_id, image_path=file)
+        try:
+            image_id = image_dataset.add_image_file(file_id=file_id, image_path=file)
+        except InvalidImageException as e:
+            print(f"skip {file}: {e}")
+            continue
 
         if skip_register:
             # センシティブ画像の登録をスキップ
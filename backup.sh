@@ -7,7 +7,9 @@ TARGET_DIR=$1
 IMAGES_DIR=$TARGET_DIR/images
 SQL_FILE=$TARGET_DIR/db.sqlite3
 
-TMP_IMAGE_FILE=/tmp/backup_tmp.tar.gz
+TMP_DIR=$(mktemp -d)
+TMP_IMAGE_FILE=$TMP_DIR/backup_tmp.tar.gz
+trap "rm -rf $TMP_DIR" EXIT
 
 if [ ! -d $IMAGES_DIR ] || [ ! -f $SQL_FILE ]; then
     echo "${IMAGES_DIR} or ${SQL_FILE} does not exist"
@@ -1,11 +1,12 @@
 import datetime
 import io
 import logging
+import threading
 import time
-import traceback
+from concurrent.futures import Executor, ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Callable, Dict, Optional
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Union
 
 import requests
 from PIL import Image
@@ -25,6 +26,7 @@ class ReplyRef:
 
 class BskyBot:
     init_session: Callable[[], Dict]
+    max_images = 4
 
     def __init__(
         self,
@@ -33,12 +35,22 @@ class BskyBot:
         min_request_interval_sec: int = 0,
         max_retry: int = 5,
         logger: logging.Logger = logging.getLogger(__name__),
+        http: Optional[requests.Session] = None,
+        executor: Optional[Executor] = None,
     ) -> None:
+        """
+        Args:
+            http: 複数のbotでコネクションプールを共有するときに渡す
+            executor: 画像の並列アップロードに使う．渡さなければ都度スレッドを立てる
+        """
         assert len(username), "Empty username"
         assert len(password), "Empty password"
         self.api_server = "https://bsky.social"
         self.logger = logger
+        self.http = http if http is not None else requests.Session()
+        self.executor = executor
         self.last_requested = None
+        self.last_requested_lock = threading.Lock()
         self.min_request_interval_sec = min_request_interval_sec
         self.max_retry = max_retry
         self.init_session = lambda: self.init_session_impl(username, password)
@@ -49,12 +61,11 @@ class BskyBot:
 
     def __may_wait(self) -> None:
         """May wait `min_request_interval_sec` to avoid too frequent request to the api server."""
-        if self.last_requested is None:
-            self.last_requested = datetime.datetime.now()
-        else:
+        with self.last_requested_lock:
             now = datetime.datetime.now()
-            time.sleep(min(self.min_request_interval_sec, (now - self.last_requested).seconds))
-            self.last_requested = now
+            last_requested, self.last_requested = self.last_requested, now
+        if last_requested is not None:
+            time.sleep(min(self.min_request_interval_sec, (now - last_requested).seconds))
 
     def __api_call(
         self,
@@ -64,19 +75,23 @@ class BskyBot:
         params: Optional[Dict] = None,
         headers: Optional[Dict] = None,
         data: Optional[bytes] = None,
+        may_wait: bool = True,
+        max_retry: Optional[int] = None,
     ) -> Dict:
-        f = {"get": requests.get, "post": requests.post}[method]
-        for _ in range(self.max_retry):
+        f = {"get": self.http.get, "post": self.http.post}[method]
+        if max_retry is None:
+            max_retry = self.max_retry
+        for i in range(max_retry):
             try:
-                self.__may_wait()
+                if may_wait or i > 0:
+                    self.__may_wait()
                 res = f(url, json=json, params=params, headers=headers, data=data)
                 assert res.ok, res.text
                 json_dict = res.json()
                 return json_dict
             except Exception as e:
-                self.logger.error(f"Failed to call api {method} {url} {json} {params} due to {e}")
-                self.logger.error(traceback.print_exc())
-        raise RuntimeError(f"Reaches max retry = {self.max_retry}")
+                self.logger.error("Failed to call api %s %s %s due to %s", method, url, params, e, exc_info=True)
+        raise RuntimeError(f"Reaches max retry = {max_retry}")
 
     def init_session_impl(self, username: str, password: str) -> Dict:
         self.logger.info("Initialize session")
@@ -89,7 +104,7 @@ class BskyBot:
         return data
 
     def update_seen(self) -> Dict:
-        self.logger.info(f"Update seen")
+        self.logger.info("Update seen")
         seen_at = datetime.datetime.now().isoformat().replace("+00:00", "Z")
         return self.__api_call(
             "post",
@@ -99,7 +114,7 @@ class BskyBot:
         )
 
     def get_notifications(self, limit: int = 1) -> Dict:
-        self.logger.info(f"Get {limit} notifications")
+        self.logger.info("Get %d notifications", limit)
         assert limit > 0, "limit <= 0"
         return self.__api_call(
             "get",
@@ -109,7 +124,7 @@ class BskyBot:
         )
 
     def get_post_thread(self, uri: str, depth: int) -> Dict[str, Any]:
-        self.logger.info(f"Get thread uri = {uri} ")
+        self.logger.info("Get thread uri = %s", uri)
         return self.__api_call(
             "get",
             self.api_server + "/xrpc/app.bsky.feed.getPostThread",
@@ -117,24 +132,54 @@ class BskyBot:
             headers=self.__init_headers(),
         )
 
-    def upload_blob(self, image: Path) -> Dict[str, Any]:
-        self.logger.info("Upload image")
+    def upload_blob(self, image: Union[Path, BinaryIO], may_wait: bool = True) -> Dict[str, Any]:
+        self.logger.info("Upload image %s", image)
         headers = self.__init_headers()
         headers["Content-Type"] = "image/jpeg"
         with io.BytesIO() as buffer:
             Image.open(image).save(buffer, "JPEG")
             buffer.seek(0)
             return self.__api_call(
-                "post", self.api_server + "/xrpc/com.atproto.repo.uploadBlob", data=buffer.read(), headers=headers
+                "post",
+                self.api_server + "/xrpc/com.atproto.repo.uploadBlob",
+                data=buffer.read(),
+                headers=headers,
+                may_wait=may_wait,
             )
 
+    def upload_blobs(self, images: List[Union[Path, BinaryIO]]) -> List[Dict[str, Any]]:
+        """複数の画像を並列にアップロードして，それぞれのblobを返す"""
+        if len(images) <= 1:
+            return [self.upload_blob(image)["blob"] for image in images]
+        # まとめて1リクエスト分だけ待つ
+        self.__may_wait()
+        upload = lambda image: self.upload_blob(image, may_wait=False)
+        if self.executor is not None:
+            return [x["blob"] for x in self.executor.map(upload, images)]
+        with ThreadPoolExecutor(max_workers=len(images)) as executor:
+            return [x["blob"] for x in executor.map(upload, images)]
+
+    def download(self, url: str) -> bytes:
+        self.logger.info("Download %s", url)
+        res = self.http.get(url)
+        res.raise_for_status()
+        return res.content
+
     def create_record(
         self,
         text: str,
-        image: Optional[Path] = None,
+        images: Optional[List[Union[Path, BinaryIO]]] = None,
         reply_ref: Optional[ReplyRef] = None,
+        image_blobs: Optional[List[Dict[str, Any]]] = None,
+        alts: Optional[List[str]] = None,
+        max_retry: Optional[int] = None,
     ) -> Dict:
-        self.logger.info(f"Post feed text={text}, images={image}")
+        """投稿する．`image_blobs`に`upload_blobs`済みのblobを渡すと画像のアップロードを省略できる
+
+        Args:
+            max_retry: createRecordのリトライ回数．指定しなければ`self.max_retry`
+        """
+        self.logger.info("Post feed text=%s, images=%s", text, images)
         data = {
             "repo": self.did,
             "collection": "app.bsky.feed.post",
@@ -149,14 +194,22 @@ class BskyBot:
                 "root": {"uri": reply_ref.root.uri, "cid": reply_ref.root.cid},
                 "parent": {"uri": reply_ref.parent.uri, "cid": reply_ref.parent.cid},
             }
-        if image:
-            image_ref = self.upload_blob(image)
+        if images and image_blobs is None:
+            image_blobs = self.upload_blobs(images)
+        if image_blobs:
+            assert len(image_blobs) <= self.max_images, f"Too many images {len(image_blobs)}"
+            if alts is None:
+                alts = [""] * len(image_blobs)
+            assert len(alts) == len(image_blobs)
             data["record"]["embed"] = {
                 "$type": "app.bsky.embed.images",
-                "images": [{"alt": "", "image": image_ref["blob"]}],
+                "images": [{"alt": alt, "image": image_blob} for alt, image_blob in zip(alts, image_blobs)],
             }
-            data["record"]["embed"]["$type"] = "app.bsky.embed.images"
 
         return self.__api_call(
-            "post", self.api_server + "/xrpc/com.atproto.repo.createRecord", json=data, headers=self.__init_headers()
+            "post",
+            self.api_server + "/xrpc/com.atproto.repo.createRecord",
+            json=data,
+            headers=self.__init_headers(),
+            max_retry=max_retry,
         )
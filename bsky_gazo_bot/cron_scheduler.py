@@ -12,9 +12,11 @@ class CronScheduler:
             time.sleep(60)
             if x():
                 print("時間だよ")
+
+    `offset_sec`を負にすると指定時刻の少し前にTrueを返す(投稿の事前準備用)
     """
 
-    def __init__(self, target_hours: list[int], zone: str = "Asia/Tokyo"):
+    def __init__(self, target_hours: list[int], zone: str = "Asia/Tokyo", offset_sec: int = 0):
         self.tz = ZoneInfo(zone)
         now = datetime.now(tz=self.tz)
         buffer = []
@@ -23,7 +25,7 @@ class CronScheduler:
             x = datetime(year=now.year, month=now.month, day=now.day, hour=target_hour, tzinfo=self.tz)
             if diff < 0:
                 x += timedelta(days=1)
-            buffer.append(x)
+            buffer.append(x + timedelta(seconds=offset_sec))
         self.buffer = deque(sorted(buffer))
 
     def __call__(self) -> bool:
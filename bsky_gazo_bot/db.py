@@ -1,17 +1,22 @@
 import datetime
+import io
 import logging
 import random
-import shutil
+import time
+from collections import OrderedDict
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import List, Optional, Set, Tuple
 
+import PIL.Image
 import sqlalchemy
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.schema import Column
-from sqlalchemy.sql.expression import func
+from sqlalchemy.sql.expression import func, or_
 from sqlalchemy.types import Boolean, DateTime, Integer, String
 
+from bsky_gazo_bot.storage import ImageStorage
+
 Base = declarative_base()
 
 
@@ -19,6 +24,37 @@ class EmptyPostImageException(Exception):
     pass
 
 
+class InvalidImageException(Exception):
+    pass
+
+
+def validate_image(image_data: bytes, full_decode: bool = False) -> Tuple[str, int, int]:
+    """画像として読めるか確認する．`full_decode`がFalseならヘッダだけを読む
+
+    Returns:
+        format, width, height
+    Raises:
+        InvalidImageException
+    """
+    try:
+        with PIL.Image.open(io.BytesIO(image_data)) as image:
+            res = (image.format, image.width, image.height)
+            if full_decode:
+                image.load()
+            else:
+                image.verify()
+    except Exception as e:
+        raise InvalidImageException(str(e)) from e
+    return res
+
+
+def create_engine(data_dir: Path) -> sqlalchemy.engine.Engine:
+    data_dir.mkdir(parents=True, exist_ok=True)
+    engine = sqlalchemy.create_engine(f'sqlite:///{data_dir.absolute() / "db.sqlite3"}')
+    Base.metadata.create_all(engine)
+    return engine
+
+
 class Image(Base):
     __tablename__ = "image"
     id = Column(Integer, primary_key=True)
@@ -46,16 +82,90 @@ class ImagePostHistory(Base):
     post_date = Column(DateTime)
 
 
+class ImagePostStats(Base):
+    """画像ごとの投稿状況．`image_post_history`を集計したもの"""
+
+    __tablename__ = "image_post_stats"
+    image_id = Column(Integer, primary_key=True)
+    last_posted_at = Column(DateTime)
+    post_count = Column(Integer, default=0)
+    last_pulled_at = Column(DateTime)
+
+
+class ImageHealth(Base):
+    """画像ファイルの検査結果．`ok`がFalseの画像は投稿しない"""
+
+    __tablename__ = "image_health"
+    image_id = Column(Integer, primary_key=True)
+    ok = Column(Boolean)
+    format = Column(String(255))
+    width = Column(Integer)
+    height = Column(Integer)
+    error = Column(String)
+    checked_date = Column(DateTime)
+
+
+is_healthy = or_(ImageHealth.ok.is_(None), ImageHealth.ok == True)
+
+
 class ImageDataset:
-    def __init__(self, data_dir: Path, logger: logging.Logger = logging.getLogger(__name__)):
+    def __init__(
+        self,
+        data_dir: Path,
+        logger: logging.Logger = logging.getLogger(__name__),
+        engine: Optional[sqlalchemy.engine.Engine] = None,
+    ):
         data_dir.mkdir(parents=True, exist_ok=True)
         self.logger = logger
 
         self.image_file_dir = data_dir / "images"
-        self.image_file_dir.mkdir(parents=True, exist_ok=True)
-        engine = sqlalchemy.create_engine(f'sqlite:///{data_dir.absolute() / "db.sqlite3"}')
-        Base.metadata.create_all(engine)
+        self.storage = ImageStorage(self.image_file_dir, logger=logger)
+        if engine is None:
+            engine = create_engine(data_dir)
         self.session = sessionmaker(engine)()
+        if self.session.query(ImagePostStats).first() is None:
+            self.backfill_post_stats()
+
+    def backfill_post_stats(self) -> int:
+        """`image_post_history`から`image_post_stats`を作り直す"""
+        rows = (
+            self.session.query(
+                ImagePostHistory.image_id, func.max(ImagePostHistory.post_date), func.count(ImagePostHistory.id)
+            )
+            .group_by(ImagePostHistory.image_id)
+            .all()
+        )
+        for image_id, last_posted_at, post_count in rows:
+            self.session.merge(ImagePostStats(image_id=image_id, last_posted_at=last_posted_at, post_count=post_count))
+        self.session.commit()
+        self.logger.info("Backfill post stats: %s images.", len(rows))
+        return len(rows)
+
+    def __get_post_stats(self, image_id: int) -> ImagePostStats:
+        stats = self.session.get(ImagePostStats, image_id)
+        if stats is None:
+            stats = ImagePostStats(image_id=image_id, post_count=0)
+            self.session.add(stats)
+        return stats
+
+    def record_posts(self, image_ids: List[int], post_date: Optional[datetime.datetime] = None) -> None:
+        """画像を投稿したことを記録する．履歴と`image_post_stats`は同じトランザクションで更新する"""
+        if post_date is None:
+            post_date = datetime.datetime.now()
+        for image_id in image_ids:
+            self.session.add(ImagePostHistory(image_id=image_id, post_date=post_date))
+            stats = self.__get_post_stats(image_id)
+            stats.last_posted_at = post_date
+            stats.post_count += 1
+        self.session.commit()
+
+    def compact_post_history(self, retention_sec: int) -> int:
+        """`retention_sec`より古い投稿履歴を削除する．集計は`image_post_stats`に残っている"""
+        threshold = datetime.datetime.now() - datetime.timedelta(seconds=retention_sec)
+        n = self.session.query(ImagePostHistory).filter(ImagePostHistory.post_date < threshold).delete()
+        self.session.commit()
+        self.logger.info("Compact post history: %s rows older than %s are deleted.", n, threshold)
+        return n
 
     def is_added(self, post_cid: str, post_uri: str) -> bool:
         return (
@@ -63,31 +173,94 @@ class ImageDataset:
             is None
         )
 
-    def add_image_file(self, file_id: str, image_path: Path) -> int:
-        self.logger.info(f"add image file id={file_id} image_path={image_path}")
-        assert image_path.exists() and image_path.suffix == ".jpg"
-        image_path_dst = (self.image_file_dir / f"{file_id}").with_suffix(".jpg")
-        assert not image_path_dst.exists(), image_path_dst
-        shutil.copy(image_path, image_path_dst)
-        image = Image(
-            post_cid=file_id, post_uri=file_id, index=0, filename=image_path_dst.name, add_date=datetime.datetime.now()
+    def get_added_indices(self, post_cid: str, post_uri: str) -> Set[int]:
+        """投稿の画像のうち保存済みのもののindex"""
+        rows = (
+            self.session.query(Image.index).filter(Image.post_cid == post_cid).filter(Image.post_uri == post_uri).all()
         )
+        return {x[0] for x in rows}
+
+    def __add_image(self, image: Image, image_data: bytes) -> int:
+        """画像を検査してから保存する．画像として読めなければ`InvalidImageException`"""
+        # NOTE: JPEGはヘッダだけでは途中で切れたファイルを検出できないので，全体をデコードする
+        checked_date = datetime.datetime.now()
+        image_format, width, height = validate_image(image_data, full_decode=True)
+        self.storage.write(image.filename, image_data)
         self.session.add(image)
+        self.session.flush()
+        self.session.add(
+            ImageHealth(
+                image_id=image.id,
+                ok=True,
+                format=image_format,
+                width=width,
+                height=height,
+                checked_date=checked_date,
+            )
+        )
         self.session.commit()
         return image.id
 
+    def add_image_file(self, file_id: str, image_path: Path) -> int:
+        self.logger.info("add image file id=%s image_path=%s", file_id, image_path)
+        assert image_path.exists() and image_path.suffix == ".jpg"
+        filename = f"{file_id}.jpg"
+        image = Image(post_cid=file_id, post_uri=file_id, index=0, filename=filename, add_date=datetime.datetime.now())
+        return self.__add_image(image, image_path.read_bytes())
+
     def add(self, post_cid: str, post_uri: str, index: int, image_data: bytes) -> int:
-        self.logger.info(f"Add image cid={post_cid} uri={post_uri}")
-        filename = (self.image_file_dir / f"{post_cid}_{index:01}").with_suffix(".jpg")
-        assert not filename.exists(), filename
-        with filename.open("wb") as f:
-            f.write(image_data)
+        self.logger.info("Add image cid=%s uri=%s", post_cid, post_uri)
+        filename = f"{post_cid}_{index:01}.jpg"
         image = Image(
-            post_cid=post_cid, post_uri=post_uri, index=index, filename=filename.name, add_date=datetime.datetime.now()
+            post_cid=post_cid, post_uri=post_uri, index=index, filename=filename, add_date=datetime.datetime.now()
         )
-        self.session.add(image)
+        return self.__add_image(image, image_data)
+
+    def scan_health(
+        self, max_files: int = 20, rescan_sec: int = 7 * 24 * 60 * 60, time_budget_sec: Optional[float] = None
+    ) -> Tuple[int, int, int]:
+        """未検査または最後の検査から`rescan_sec`経った画像を古い順に最大`max_files`個，全体をデコードして検査する
+
+        検査済みの画像は次の呼び出しで選ばれないので，少しずつ呼べば続きから再開できる
+
+        Args:
+            time_budget_sec: 1回の呼び出しで検査に使う時間の上限．上限を超えても1個は検査する
+        Returns:
+            検査した画像の数，そのうち壊れていた画像の数，読み込んだバイト数
+        """
+        checked_date = datetime.datetime.now()
+        threshold = checked_date - datetime.timedelta(seconds=rescan_sec)
+        rows = (
+            self.session.query(Image, ImageHealth)
+            .outerjoin(ImageHealth, ImageHealth.image_id == Image.id)
+            .filter(or_(ImageHealth.checked_date.is_(None), ImageHealth.checked_date <= threshold))
+            .order_by(ImageHealth.checked_date.is_(None).desc(), ImageHealth.checked_date, Image.id)
+            .limit(max_files)
+            .all()
+        )
+        n_checked, n_broken, n_bytes = 0, 0, 0
+        # NOTE: クエリに時間がかかっても検査が進むように，クエリの後から測る
+        start = time.monotonic()
+        for image, health in rows:
+            if n_checked > 0 and time_budget_sec is not None and time.monotonic() - start > time_budget_sec:
+                break
+            if health is None:
+                health = ImageHealth(image_id=image.id)
+                self.session.add(health)
+            try:
+                image_data = self.storage.read_bytes(image.filename)
+                n_bytes += len(image_data)
+                health.format, health.width, health.height = validate_image(image_data, full_decode=True)
+                health.ok, health.error = True, None
+            except (OSError, InvalidImageException) as e:
+                self.logger.warning("Broken image id=%s filename=%s due to %s", image.id, image.filename, e)
+                health.ok, health.error = False, str(e)
+                n_broken += 1
+            health.checked_date = checked_date
+            n_checked += 1
         self.session.commit()
-        return image.id
+        self.logger.info("Scan health: %s images, %s broken.", n_checked, n_broken)
+        return n_checked, n_broken, n_bytes
 
     def register_all_ok(self) -> list[int]:
         checked_date = datetime.datetime.now()
@@ -101,7 +274,7 @@ class ImageDataset:
                 self.session.add(image_check)
                 res.append(image.id)
         self.session.commit()
-        self.logger.info(f"register_all_ok: {len(res)} images.")
+        self.logger.info("register_all_ok: %s images.", len(res))
         return res
 
     def register_image(
@@ -111,7 +284,7 @@ class ImageDataset:
         ng_reason: Optional[str] = None,
         checked_date: Optional[datetime.datetime] = None,
     ) -> None:
-        self.logger.info(f"Register image {image_id}, {is_ok}, {ng_reason}, {checked_date}")
+        self.logger.info("Register image %s, %s, %s, %s", image_id, is_ok, ng_reason, checked_date)
         if checked_date is None:
             checked_date = datetime.datetime.now()
         if not is_ok:
@@ -129,47 +302,73 @@ class ImageDataset:
         self.session.commit()
 
     def random_sample(self) -> Path:
-        self.logger.info("Random sample")
-        image = self.session.query(Image).order_by(func.random()).first()
-        if image is None:
+        return self.random_sample_many(1)[0]
+
+    def random_sample_many(self, n: int) -> List[Path]:
+        """重複しない画像を最大`n`個ランダムに選ぶ"""
+        self.logger.info("Random sample %s images", n)
+        images = (
+            self.session.query(Image)
+            .outerjoin(ImageHealth, ImageHealth.image_id == Image.id)
+            .filter(is_healthy)
+            .order_by(func.random())
+            .limit(n)
+            .all()
+        )
+        if len(images) == 0:
             raise EmptyPostImageException
-        return self.image_file_dir / image.filename
+        pulled_at = datetime.datetime.now()
+        for image in images:
+            self.__get_post_stats(image.id).last_pulled_at = pulled_at
+        self.session.commit()
+        return [self.storage.resolve(image.filename) for image in images]
 
     def sample(self, seconds: int = 0) -> Path:
-        self.logger.info(f"Sample an image {seconds}")
-        no_posted: List[ImageCheck] = []
-        no_posted_since_n_secs: List[Tuple[ImageCheck, int]] = []
+        return self.sample_many(1, seconds=seconds)[0]
+
+    def sample_many(self, n: int, seconds: int = 0) -> List[Path]:
+        """`choose_many`で選んだ画像を投稿済みとして記録して返す"""
+        images = self.choose_many(n, seconds=seconds)
+        self.record_posts([image_id for image_id, _ in images])
+        return [path for _, path in images]
+
+    def choose_many(self, n: int, seconds: int = 0) -> List[Tuple[int, Path]]:
+        """投稿する画像を重複なしで最大`n`個選ぶ．未投稿の画像を優先し，次に最後の投稿から時間が経っているものほど選ばれやすい
+
+        投稿の記録はしないので，投稿できたら`record_posts`を呼ぶこと
+        Returns:
+            List of image's id and path
+        """
+        self.logger.info("Choose %s images %s", n, seconds)
+        no_posted: List[Tuple[int, str]] = []
+        no_posted_since_n_secs: List[Tuple[Tuple[int, str], int]] = []
         post_date = datetime.datetime.now()
-        for image_check in self.session.query(ImageCheck).filter(ImageCheck.ok == True).all():
-            image_post_history = (
-                self.session.query(ImagePostHistory)
-                .filter(ImagePostHistory.image_id == image_check.image_id)
-                .order_by(sqlalchemy.desc(ImagePostHistory.post_date))
-                .first()
-            )
-            if image_post_history:
-                diff: int = (post_date - image_post_history.post_date).total_seconds()
+        rows = (
+            self.session.query(Image.id, Image.filename, ImagePostStats.last_posted_at)
+            .join(ImageCheck, ImageCheck.image_id == Image.id)
+            .outerjoin(ImagePostStats, ImagePostStats.image_id == Image.id)
+            .outerjoin(ImageHealth, ImageHealth.image_id == Image.id)
+            .filter(ImageCheck.ok == True)
+            .filter(is_healthy)
+            .all()
+        )
+        for image_id, filename, last_posted_at in rows:
+            if last_posted_at:
+                diff: int = (post_date - last_posted_at).total_seconds()
                 if diff > seconds:
-                    no_posted_since_n_secs.append((image_check, diff))
+                    no_posted_since_n_secs.append(((image_id, filename), diff))
             else:
-                no_posted.append(image_check)
+                no_posted.append((image_id, filename))
 
-        if len(no_posted):
-            image_check = random.choice(no_posted)
-            image = self.session.query(Image).filter(Image.id == image_check.image_id).first()
-            self.session.add(ImagePostHistory(image_id=image.id, post_date=post_date))
-            self.session.commit()
-            return self.image_file_dir / image.filename
-
-        if len(no_posted_since_n_secs):
+        images = random.sample(no_posted, min(n, len(no_posted)))
+        while len(images) < n and len(no_posted_since_n_secs):
             weights = [x[1] for x in no_posted_since_n_secs]
-            image_check, image_post_history = random.choices(no_posted_since_n_secs, weights=weights)[0]
-            image = self.session.query(Image).filter(Image.id == image_check.image_id).first()
-            self.session.add(ImagePostHistory(image_id=image.id, post_date=post_date))
-            self.session.commit()
-            return self.image_file_dir / image.filename
+            i = random.choices(range(len(no_posted_since_n_secs)), weights=weights)[0]
+            images.append(no_posted_since_n_secs.pop(i)[0])
 
-        raise EmptyPostImageException("Not image to be post")
+        if len(images) == 0:
+            raise EmptyPostImageException("Not image to be post")
+        return [(image_id, self.storage.resolve(filename)) for image_id, filename in images]
 
     def get_all_post_history(self):
         self.logger.info("Get Post history")
@@ -206,11 +405,16 @@ class Reply(Base):
 
 
 class ReplyDataset:
-    def __init__(self, data_dir: Path, logger: logging.Logger = logging.getLogger(__name__)):
+    def __init__(
+        self,
+        data_dir: Path,
+        logger: logging.Logger = logging.getLogger(__name__),
+        engine: Optional[sqlalchemy.engine.Engine] = None,
+    ):
         data_dir.mkdir(parents=True, exist_ok=True)
         self.logger = logger
-        engine = sqlalchemy.create_engine(f'sqlite:///{data_dir.absolute() / "db.sqlite3"}')
-        Base.metadata.create_all(engine)
+        if engine is None:
+            engine = create_engine(data_dir)
         self.session = sessionmaker(engine)()
 
     def is_added(self, post_cid: str, post_uri: str) -> bool:
@@ -220,7 +424,9 @@ class ReplyDataset:
         )
 
     def add(self, post_cid: str, post_uri: str, post_text: str, reply_text: str) -> None:
-        self.logger.info(f"Add reply cid={post_cid} uri={post_uri} post_text={post_text} reply_text={reply_text}")
+        self.logger.info(
+            "Add reply cid=%s uri=%s post_text=%s reply_text=%s", post_cid, post_uri, post_text, reply_text
+        )
         reply = Reply(
             post_cid=post_cid,
             post_uri=post_uri,
@@ -230,3 +436,73 @@ class ReplyDataset:
         )
         self.session.add(reply)
         self.session.commit()
+
+
+class ProcessedNotification(Base):
+    __tablename__ = "processed_notification"
+    uri = Column(String(255), primary_key=True)
+    cid = Column(String(255))
+    outcome = Column(String(255))
+    processed_date = Column(DateTime)
+
+
+class NotificationRegistry:
+    """処理済みの通知を記録する．直近のものはメモリに持つので，定常状態ではDBに問い合わせない"""
+
+    def __init__(
+        self,
+        data_dir: Path,
+        logger: logging.Logger = logging.getLogger(__name__),
+        engine: Optional[sqlalchemy.engine.Engine] = None,
+        cache_size: int = 10000,
+    ):
+        data_dir.mkdir(parents=True, exist_ok=True)
+        self.logger = logger
+        if engine is None:
+            engine = create_engine(data_dir)
+        self.session = sessionmaker(engine)()
+        self.cache_size = cache_size
+        self.cache: OrderedDict[str, None] = OrderedDict()
+        if self.session.query(ProcessedNotification).first() is None:
+            self.backfill()
+
+    def backfill(self) -> int:
+        """画像を保存した投稿と返信した投稿を処理済みとして登録する"""
+        processed_date = datetime.datetime.now()
+        rows = [(uri, cid, "image") for uri, cid in self.session.query(Image.post_uri, Image.post_cid).distinct()]
+        rows += [(uri, cid, "reply") for uri, cid in self.session.query(Reply.post_uri, Reply.post_cid).distinct()]
+        for uri, cid, outcome in rows:
+            self.session.merge(ProcessedNotification(uri=uri, cid=cid, outcome=outcome, processed_date=processed_date))
+        self.session.commit()
+        self.logger.info("Backfill processed notifications: %s notifications.", len(rows))
+        return len(rows)
+
+    def __cache(self, uri: str) -> None:
+        self.cache[uri] = None
+        self.cache.move_to_end(uri)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def filter_unprocessed(self, uris: List[str], chunk_size: int = 500) -> List[str]:
+        """`uris`のうち未処理のものを返す．キャッシュにないものだけをまとめてDBに問い合わせる"""
+        misses = []
+        for uri in uris:
+            if uri in self.cache:
+                self.cache.move_to_end(uri)
+            else:
+                misses.append(uri)
+        processed = set()
+        for i in range(0, len(misses), chunk_size):
+            chunk = misses[i : i + chunk_size]
+            for (uri,) in self.session.query(ProcessedNotification.uri).filter(ProcessedNotification.uri.in_(chunk)):
+                processed.add(uri)
+                self.__cache(uri)
+        return [uri for uri in misses if uri not in processed]
+
+    def add(self, uri: str, cid: str, outcome: str) -> None:
+        self.logger.info("Processed notification uri=%s outcome=%s", uri, outcome)
+        self.session.merge(
+            ProcessedNotification(uri=uri, cid=cid, outcome=outcome, processed_date=datetime.datetime.now())
+        )
+        self.session.commit()
+        self.__cache(uri)
@@ -1,12 +1,32 @@
+import contextlib
+import datetime
 import logging
+import os
 import subprocess
+from concurrent.futures import Executor
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
 
 import requests
 
 from bsky_gazo_bot.bsky_bot import BskyBot, Ref, ReplyRef
-from bsky_gazo_bot.db import EmptyPostImageException, ImageDataset, ReplyDataset
+from bsky_gazo_bot.db import (
+    EmptyPostImageException,
+    ImageDataset,
+    InvalidImageException,
+    NotificationRegistry,
+    ReplyDataset,
+    create_engine,
+)
+
+
+@dataclass
+class PrewarmedPost:
+    image_ids: List[int]
+    images: List[Path]
+    image_blobs: Optional[List[Dict[str, Any]]]
+    uploaded_at: datetime.datetime
 
 
 class GazoBot:
@@ -16,50 +36,94 @@ class GazoBot:
         username: str,
         password: str,
         seconds_duplicate_post: int,
+        prewarm_max_age_sec: int = 30 * 60,
+        post_image_count: int = 1,
+        pull_image_count: int = 1,
+        backup_dir: Optional[Path] = None,
         logger: logging.Logger = logging.getLogger(__name__),
+        http: Optional[requests.Session] = None,
+        executor: Optional[Executor] = None,
     ) -> None:
         self.logger = logger
         self.seconds_duplicate_post = seconds_duplicate_post
-        self.bsky_bot = BskyBot(username, password, min_request_interval_sec=1, logger=logger)
-        self.image_dataset = ImageDataset(data_dir=data_dir, logger=logger)
-        self.reply_dataset = ReplyDataset(data_dir=data_dir, logger=logger)
+        self.prewarm_max_age_sec = prewarm_max_age_sec
+        assert 0 < post_image_count <= BskyBot.max_images, post_image_count
+        assert 0 < pull_image_count <= BskyBot.max_images, pull_image_count
+        self.post_image_count = post_image_count
+        self.pull_image_count = pull_image_count
+        self.prewarmed: Optional[PrewarmedPost] = None
+        self.bsky_bot = BskyBot(
+            username, password, min_request_interval_sec=1, logger=logger, http=http, executor=executor
+        )
+        engine = create_engine(data_dir)
+        self.image_dataset = ImageDataset(data_dir=data_dir, logger=logger, engine=engine)
+        self.reply_dataset = ReplyDataset(data_dir=data_dir, logger=logger, engine=engine)
+        self.notification_registry = NotificationRegistry(data_dir=data_dir, logger=logger, engine=engine)
         self.data_dir = data_dir
+        self.backup_dir = backup_dir
         self.username = username
 
     def backup_data_dir(self) -> None:
-        res = subprocess.run(f"bash backup.sh {self.data_dir}".split(), capture_output=True)
-        self.logger.info(f"Run backup.sh. returncode = {res.returncode}, {res.stdout.decode()} {res.stderr.decode()}")
+        env = None
+        if self.backup_dir is not None:
+            env = {**os.environ, "BACKUP_DIR": str(self.backup_dir)}
+        res = subprocess.run(f"bash backup.sh {self.data_dir}".split(), capture_output=True, env=env)
+        self.logger.info(
+            "Run backup.sh. returncode = %s, %s %s", res.returncode, res.stdout.decode(), res.stderr.decode()
+        )
         assert res.returncode == 0, f"Failed to run backup.sh"
 
     def reset_session(self) -> None:
-        self.logger.info(f"Init session")
+        self.logger.info("Init session")
         self.bsky_bot.init_session()
 
-    def __gather_image(self, notification: Dict) -> None:
-        # もし登録されていなかったら画像投稿の詳細を取得
+    def __gather_image(self, notification: Dict) -> Optional[str]:
+        """Returns: 処理結果．ダウンロードに一時的に失敗した画像があれば`None`で，次回に残りを保存する"""
         cid, uri = notification["cid"], notification["uri"]
-        if self.image_dataset.is_added(cid, uri):
-            return
+        added_indices = self.image_dataset.get_added_indices(cid, uri)
 
         # ダウンロードして保存
         data = self.bsky_bot.get_post_thread(uri, 1)
-        if "thread" in data:
-            thread = data["thread"]
-            for i, image in enumerate(thread["post"]["embed"]["images"]):
-                self.image_dataset.add(cid, uri, i, requests.get(image["fullsize"]).content)
+        if not "thread" in data:
+            return "not_found"
+        thread = data["thread"]
+        n_added, n_failed = 0, 0
+        for i, image in enumerate(thread["post"]["embed"]["images"]):
+            if i in added_indices:
+                continue
+            try:
+                self.image_dataset.add(cid, uri, i, self.bsky_bot.download(image["fullsize"]))
+                n_added += 1
+            except InvalidImageException as e:
+                self.logger.warning("Skip invalid image %s of %s due to %s", i, uri, e)
+            except requests.HTTPError as e:
+                if e.response is not None and 400 <= e.response.status_code < 500:
+                    self.logger.warning("Skip image %s of %s due to %s", i, uri, e)
+                else:
+                    self.logger.warning("Failed to download image %s of %s due to %s. Retry later.", i, uri, e)
+                    n_failed += 1
+            except requests.RequestException as e:
+                self.logger.warning("Failed to download image %s of %s due to %s. Retry later.", i, uri, e)
+                n_failed += 1
+        if n_failed > 0:
+            return None
+        if n_added == 0:
+            return "image" if added_indices else "invalid"
 
-            # お礼を投稿
-            self.bsky_bot.create_record(
-                "受け付けました。確認の上で投稿候補に加わります。", reply_ref=ReplyRef(root=Ref(uri=uri, cid=cid), parent=Ref(uri=uri, cid=cid))
-            )
+        # お礼を投稿
+        self.bsky_bot.create_record(
+            "受け付けました。確認の上で投稿候補に加わります。", reply_ref=ReplyRef(root=Ref(uri=uri, cid=cid), parent=Ref(uri=uri, cid=cid))
+        )
+        return "image"
 
-    def __reply_to_text(self, notification: Dict) -> None:
+    def __reply_to_text(self, notification: Dict) -> str:
+        """Returns: 処理結果"""
         cid, uri = notification["cid"], notification["uri"]
         if self.reply_dataset.is_added(cid, uri):
-            return
+            return "reply"
         data = self.bsky_bot.get_post_thread(uri, 1)
         if not "thread" in data:
-            return
+            return "not_found"
         thread = data["thread"]
         text = thread["post"]["record"]["text"]
         text = text.replace(f"@{self.username} ", "").strip()
@@ -70,28 +134,34 @@ class GazoBot:
                 reply_text, reply_ref=ReplyRef(root=Ref(uri=uri, cid=cid), parent=Ref(uri=uri, cid=cid))
             )
             self.reply_dataset.add(cid, uri, text, reply_text)
+            return "reply"
         elif text == "pull":
             try:
-                image = self.image_dataset.random_sample()
+                images = self.image_dataset.random_sample_many(self.pull_image_count)
             except EmptyPostImageException:
                 self.logger.info("Empty post image.")
                 self.bsky_bot.create_record(
                     "画像がありません", reply_ref=ReplyRef(root=Ref(uri=uri, cid=cid), parent=Ref(uri=uri, cid=cid))
                 )
-                return
-            self.bsky_bot.create_record(
-                "", reply_ref=ReplyRef(root=Ref(uri=uri, cid=cid), parent=Ref(uri=uri, cid=cid)), image=image
-            )
+                return "empty"
+            with self.__open_images(images) as files:
+                self.bsky_bot.create_record(
+                    "", reply_ref=ReplyRef(root=Ref(uri=uri, cid=cid), parent=Ref(uri=uri, cid=cid)), images=files
+                )
             self.reply_dataset.add(cid, uri, text, "")
+            return "reply"
         else:
-            pass
+            return "ignored"
 
     def reply_nofitications(self) -> None:
         """メンションされた投稿のうち，画像添付のもので保存したことない画像をすべて保存する"""
         self.logger.info("Gather image")
-        for notification in self.bsky_bot.get_notifications(100)["notifications"]:
-            # メンション投稿だけをフィルタリングする
-            if notification["reason"] != "mention":
+        # メンション投稿だけをフィルタリングする
+        notifications = [x for x in self.bsky_bot.get_notifications(100)["notifications"] if x["reason"] == "mention"]
+        # 処理済みの通知はまとめて除く
+        unprocessed = set(self.notification_registry.filter_unprocessed([x["uri"] for x in notifications]))
+        for notification in notifications:
+            if notification["uri"] not in unprocessed:
                 continue
 
             # 画像つき投稿のみをフィルタリングする
@@ -100,24 +170,86 @@ class GazoBot:
                 and "embed" in notification["record"]
                 and notification["record"]["embed"]["$type"] == "app.bsky.embed.images"
             ):
-                self.__gather_image(notification)
+                outcome = self.__gather_image(notification)
             else:
-                self.__reply_to_text(notification)
+                outcome = self.__reply_to_text(notification)
+            if outcome is None:
+                continue
+            self.notification_registry.add(notification["uri"], notification["cid"], outcome)
+            unprocessed.discard(notification["uri"])
+
+    def prewarm_post_image(self) -> None:
+        """次の`post_image`で投稿する画像を選んでアップロードしておく"""
+        self.logger.info("Prewarm post image")
+        self.prewarmed = None
+        try:
+            chosen = self.image_dataset.choose_many(self.post_image_count, seconds=self.seconds_duplicate_post)
+        except EmptyPostImageException:
+            self.logger.info("Empty post image.")
+            return
+        image_ids, images = [x[0] for x in chosen], [x[1] for x in chosen]
+        try:
+            with self.__open_images(images) as files:
+                image_blobs = self.bsky_bot.upload_blobs(files)
+        except Exception as e:
+            # 失敗しても`post_image`で改めてアップロードする
+            self.logger.warning("Failed to prewarm %s due to %s", images, e)
+            image_blobs = None
+        self.prewarmed = PrewarmedPost(
+            image_ids=image_ids, images=images, image_blobs=image_blobs, uploaded_at=datetime.datetime.now()
+        )
+
+    @contextlib.contextmanager
+    def __open_images(self, images: List[Path]) -> Iterator[List[BinaryIO]]:
+        """`ImageStorage.migrate`で移動されても読めるように，ストレージ経由で開く"""
+        with contextlib.ExitStack() as stack:
+            yield [stack.enter_context(self.image_dataset.storage.open(x.name)) for x in images]
+
+    def __post_images(self, images: List[Path]) -> None:
+        with self.__open_images(images) as files:
+            self.bsky_bot.create_record(text="", images=files)
+
+    def __post_prewarmed_image(self, prewarmed: PrewarmedPost) -> None:
+        age = (datetime.datetime.now() - prewarmed.uploaded_at).total_seconds()
+        if prewarmed.image_blobs is None or age > self.prewarm_max_age_sec:
+            self.logger.info("Prewarmed blobs of %s are stale. Upload again.", prewarmed.images)
+            self.__post_images(prewarmed.images)
+        else:
+            try:
+                # 古いblobが拒否されたらリトライせずにアップロードし直す
+                self.bsky_bot.create_record(text="", image_blobs=prewarmed.image_blobs, max_retry=1)
+            except RuntimeError as e:
+                self.logger.warning(
+                    "Failed to post prewarmed blobs of %s due to %s. Upload again.", prewarmed.images, e
+                )
+                self.__post_images(prewarmed.images)
+        self.image_dataset.record_posts(prewarmed.image_ids)
 
     def post_image(self) -> None:
-        """画像を1つ投稿する"""
+        """画像を`post_image_count`個まとめて投稿する．`prewarm_post_image`済みならその画像を投稿する"""
         self.logger.info("Post image")
-        image: Optional[Path] = None
+        prewarmed, self.prewarmed = self.prewarmed, None
+        if prewarmed is not None:
+            self.__post_prewarmed_image(prewarmed)
+            return
         try:
-            image = self.image_dataset.sample(seconds=self.seconds_duplicate_post)
+            chosen = self.image_dataset.choose_many(self.post_image_count, seconds=self.seconds_duplicate_post)
         except EmptyPostImageException:
             self.logger.info("Empty post image.")
             self.bsky_bot.create_record("投稿する画像がありません")
             return
-        except Exception as e:
-            raise e
-        assert image
-        self.bsky_bot.create_record(text="", image=image)
+        self.__post_images([x[1] for x in chosen])
+        self.image_dataset.record_posts([x[0] for x in chosen])
+
+    def scan_image_health(
+        self, max_files: int, rescan_sec: int, time_budget_sec: Optional[float] = None
+    ) -> Tuple[int, int]:
+        """Returns: 検査した画像の数と読み込んだバイト数"""
+        n_checked, _, n_bytes = self.image_dataset.scan_health(max_files, rescan_sec, time_budget_sec)
+        return n_checked, n_bytes
+
+    def compact_post_history(self, retention_sec: int) -> None:
+        self.image_dataset.compact_post_history(retention_sec)
 
     def close(self):
         self.backup_data_dir()
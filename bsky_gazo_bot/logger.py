@@ -0,0 +1,173 @@
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from pathlib import Path
+from typing import Optional, Tuple
+
+
+class JsonFormatter(logging.Formatter):
+    """1レコードを1行のJSONにする"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record),
+            "name": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            data["stack_info"] = self.formatStack(record.stack_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class CompressedRotatingFileHandler(RotatingFileHandler):
+    """サイズと経過時間でローテーションし，古いログをgzipで圧縮する"""
+
+    def __init__(
+        self, filename: Path, max_bytes: int = 0, backup_count: int = 1, rotate_sec: int = 0, encoding: str = "utf-8"
+    ) -> None:
+        # NOTE: `RotatingFileHandler`は`backupCount=0`だとローテーションせずに追記し続ける
+        assert backup_count >= 1, f"backup_count={backup_count} must be at least 1"
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding=encoding)
+        self.rotate_sec = rotate_sec
+        self.rotate_at = time.time() + rotate_sec
+
+    def namer(self, default_name: str) -> str:
+        return default_name + ".gz"
+
+    def rotator(self, source: str, dest: str) -> None:
+        with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.rotate_sec > 0 and time.time() >= self.rotate_at:
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self) -> None:
+        super().doRollover()
+        self.rotate_at = time.time() + self.rotate_sec
+
+
+class RepeatSamplingFilter(logging.Filter):
+    """同じメッセージ(テンプレート)が`window_sec`の間に`max_per_window`回を超えたら間引く
+
+    `pass_level`以上のレコードは間引かない．覚えておくテンプレートは`max_keys`個までで，古いものから忘れる
+    NOTE: f-stringで整形済みのメッセージは毎回別物として扱われるので，`logger.info("... %s", x)`の形で呼ぶこと
+    """
+
+    def __init__(
+        self,
+        max_per_window: int = 10,
+        window_sec: float = 60,
+        pass_level: int = logging.WARNING,
+        max_keys: int = 1000,
+    ) -> None:
+        super().__init__()
+        self.max_per_window = max_per_window
+        self.window_sec = window_sec
+        self.pass_level = pass_level
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.counts: OrderedDict[Tuple[str, int, str], Tuple[float, int]] = OrderedDict()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= self.pass_level:
+            return True
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self.lock:
+            start, count = self.counts.get(key, (now, 0))
+            if now - start > self.window_sec:
+                if count > self.max_per_window:
+                    record.msg = f"{record.msg} (suppressed {count - self.max_per_window} similar messages)"
+                start, count = now, 0
+            count += 1
+            self.counts[key] = (start, count)
+            self.counts.move_to_end(key)
+            while len(self.counts) > self.max_keys:
+                self.counts.popitem(last=False)
+        return count <= self.max_per_window
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """キューが一杯なら待たずに捨てる．整形はリスナースレッド側で行う
+
+    捨てた数は，次にキューに空きができたときにWARNINGで出す
+    """
+
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        # NOTE: `Handler.handle`のロックの中で呼ばれる
+        try:
+            if self.dropped > 0:
+                self.queue.put_nowait(
+                    logging.LogRecord(
+                        record.name,
+                        logging.WARNING,
+                        __file__,
+                        0,
+                        "Dropped %s log records because the log queue was full",
+                        (self.dropped,),
+                        None,
+                    )
+                )
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def init_logger(
+    logger: logging.Logger,
+    log_file: Optional[Path] = None,
+    max_bytes: int = 10 * 1024 * 1024,
+    backup_count: int = 10,
+    rotate_sec: int = 24 * 60 * 60,
+    queue_size: int = 10000,
+    sampling_max_per_window: int = 10,
+    sampling_window_sec: float = 60,
+    sampling_pass_level: int = logging.WARNING,
+) -> QueueListener:
+    """ロガーの出力をキュー経由にして，stdoutとファイルへの書き込みはバックグラウンドスレッドで行う
+
+    Returns:
+        開始済みの`QueueListener`．終了時に`stop()`を呼ぶとキューに残ったログを書き出す
+    """
+    [logger.removeHandler(x) for x in logger.handlers]
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter("[%(name)s %(asctime)s] %(message)s"))
+    handlers = [stream_handler]
+    if log_file is not None:
+        file_handler = CompressedRotatingFileHandler(
+            log_file, max_bytes=max_bytes, backup_count=backup_count, rotate_sec=rotate_sec
+        )
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+
+    log_queue: queue.Queue = queue.Queue(queue_size)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(RepeatSamplingFilter(sampling_max_per_window, sampling_window_sec, sampling_pass_level))
+    logger.addHandler(queue_handler)
+
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,126 @@
+import datetime
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable
+
+from bsky_gazo_bot.cron_scheduler import CronScheduler
+from bsky_gazo_bot.gazo_bot import GazoBot
+
+
+@dataclass
+class RunGazoBotConfig:
+    """NOTE: デフォルト値は`run_gazo_bot.py`の引数と`run_gazo_bot_host.py`の設定ファイルで共通"""
+
+    log_dir: Path
+    data_dir: Path
+    reply_notification_period_sec: int = 2 * 60
+    seconds_duplicate_post: int = 7 * 24 * 60 * 60
+    init_session_priod_sec: int = 60 * 60
+    backup_priod_sec: int = 12 * 60 * 60
+    heart_beat_sec: int = 5
+    post_on_start: bool = False
+    prewarm_sec: int = 5 * 60
+    post_image_count: int = 1
+    pull_image_count: int = 1
+    post_history_retention_sec: int = 365 * 24 * 60 * 60
+    compact_priod_sec: int = 24 * 60 * 60
+    post_hours: tuple[int, ...] = (13, 19)
+    prewarm_max_age_sec: int = 30 * 60
+    health_scan_period_sec: int = 10 * 60
+    health_scan_max_files: int = 100
+    health_scan_bytes_per_sec: int = 4 * 1024 * 1024
+    health_scan_step_sec: float = 0.5
+    health_rescan_sec: int = 7 * 24 * 60 * 60
+
+
+class HeartBeater:
+    def __init__(self, period_sec: int) -> None:
+        self.start = datetime.datetime.now()
+        self.period_sec = period_sec
+
+    def __call__(self) -> bool:
+        res = False
+        now = datetime.datetime.now()
+        if (now - self.start).total_seconds() > self.period_sec:
+            res = True
+            self.start = datetime.datetime.now()
+        return res
+
+
+class GazoBotRunner:
+    """`GazoBot`の定期処理をまとめたもの．`step`を`heart_beat_sec`ごとに呼ぶ
+
+    `isolate_tasks=True`なら処理ごとに例外を記録して次の処理に進む．失敗した定時投稿は次の`step`でやり直す
+    """
+
+    # 定時投稿を試みる回数
+    max_post_attempts = 3
+
+    def __init__(self, gazo_bot: GazoBot, config: RunGazoBotConfig, isolate_tasks: bool = False) -> None:
+        assert (
+            config.prewarm_sec < config.prewarm_max_age_sec
+        ), f"prewarm_sec={config.prewarm_sec} must be less than prewarm_max_age_sec={config.prewarm_max_age_sec}"
+        assert config.health_scan_bytes_per_sec > 0, f"health_scan_bytes_per_sec={config.health_scan_bytes_per_sec}"
+        self.gazo_bot = gazo_bot
+        self.config = config
+        self.isolate_tasks = isolate_tasks
+        self.reply_notification_beater = HeartBeater(config.reply_notification_period_sec)
+        self.init_session_beater = HeartBeater(config.init_session_priod_sec)
+        self.backup_beater = HeartBeater(config.backup_priod_sec)
+        self.compact_beater = HeartBeater(config.compact_priod_sec)
+        self.cron_scheduler = CronScheduler(target_hours=list(config.post_hours))
+        self.prewarm_scheduler = CronScheduler(target_hours=list(config.post_hours), offset_sec=-config.prewarm_sec)
+        self.post_attempts_left = 0
+        # 画像の検査は`step`ごとに少しずつ続け，読み込んだ量に応じて`health_scan_resume_at`まで休む
+        self.health_scan_resume_at = 0.0
+
+    def __run(self, task: Callable[..., Any], *args: Any) -> bool:
+        """Returns: 成功したかどうか"""
+        if not self.isolate_tasks:
+            task(*args)
+            return True
+        try:
+            task(*args)
+            return True
+        except Exception:
+            self.gazo_bot.logger.exception("Failed to run %s", task.__name__)
+            return False
+
+    def __scan_image_health(self) -> None:
+        start = time.monotonic()
+        n_checked, n_bytes = self.gazo_bot.scan_image_health(
+            max_files=self.config.health_scan_max_files,
+            rescan_sec=self.config.health_rescan_sec,
+            time_budget_sec=self.config.health_scan_step_sec,
+        )
+        if n_checked == 0:
+            # 検査する画像がなければ`health_scan_period_sec`待つ
+            self.health_scan_resume_at = time.monotonic() + self.config.health_scan_period_sec
+        else:
+            self.health_scan_resume_at = start + n_bytes / self.config.health_scan_bytes_per_sec
+
+    def step(self) -> None:
+        # 投稿が遅れないように定時の処理を先に行う
+        if self.config.prewarm_sec > 0 and self.prewarm_scheduler():
+            self.__run(self.gazo_bot.prewarm_post_image)
+        if self.cron_scheduler():
+            self.post_attempts_left = self.max_post_attempts
+        if self.post_attempts_left > 0:
+            self.post_attempts_left -= 1
+            if self.__run(self.gazo_bot.post_image):
+                self.post_attempts_left = 0
+        if self.init_session_beater():
+            self.__run(self.gazo_bot.reset_session)
+        if self.reply_notification_beater():
+            self.__run(self.gazo_bot.reply_nofitications)
+        if self.backup_beater():
+            self.__run(self.gazo_bot.backup_data_dir)
+        if self.config.post_history_retention_sec > 0 and self.compact_beater():
+            self.__run(self.gazo_bot.compact_post_history, self.config.post_history_retention_sec)
+        if self.config.health_scan_max_files > 0 and time.monotonic() >= self.health_scan_resume_at:
+            if not self.__run(self.__scan_image_health):
+                self.health_scan_resume_at = time.monotonic() + self.config.health_scan_period_sec
+
+    def close(self) -> None:
+        self.gazo_bot.close()
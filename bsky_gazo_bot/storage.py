@@ -0,0 +1,116 @@
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import BinaryIO, Optional
+
+
+class ImageStorage:
+    """画像ファイルをファイル名のハッシュで`ab/cd/<filename>`のようなサブディレクトリに振り分けて保存する
+
+    移行前のフラットな配置(`<root>/<filename>`)も読めるので，`migrate`はbotを動かしたまま実行できる
+    """
+
+    def __init__(
+        self, root: Path, depth: int = 2, width: int = 2, logger: logging.Logger = logging.getLogger(__name__)
+    ):
+        self.root = root
+        self.depth = depth
+        self.width = width
+        self.logger = logger
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def __check_filename(self, filename: str) -> None:
+        if Path(filename).name != filename or filename.startswith("."):
+            raise ValueError(f"Invalid filename {filename}")
+
+    def sharded_path(self, filename: str) -> Path:
+        self.__check_filename(filename)
+        digest = hashlib.sha1(filename.encode()).hexdigest()
+        shards = [digest[i * self.width : (i + 1) * self.width] for i in range(self.depth)]
+        return self.root.joinpath(*shards, filename)
+
+    def flat_path(self, filename: str) -> Path:
+        self.__check_filename(filename)
+        return self.root / filename
+
+    def resolve(self, filename: str) -> Path:
+        """ファイルの実際のパスを返す．存在しなければ新しい配置のパスを返す"""
+        sharded = self.sharded_path(filename)
+        if sharded.exists():
+            return sharded
+        flat = self.flat_path(filename)
+        if flat.exists():
+            return flat
+        # NOTE: `migrate`はリンクしてから元を消すので，ここで見つからなければ移動済み
+        return sharded
+
+    def open(self, filename: str) -> BinaryIO:
+        """開いたファイルは`migrate`で移動されても読める．解決してから開くまでの間に移動されたら解決し直す"""
+        try:
+            return self.resolve(filename).open("rb")
+        except FileNotFoundError:
+            return self.resolve(filename).open("rb")
+
+    def read_bytes(self, filename: str) -> bytes:
+        with self.open(filename) as f:
+            return f.read()
+
+    def exists(self, filename: str) -> bool:
+        return self.resolve(filename).exists()
+
+    def write(self, filename: str, data: bytes) -> Path:
+        """一時ファイルに書いてからrenameする．書きかけのファイルが見えることはない"""
+        assert not self.exists(filename), filename
+        dst = self.sharded_path(filename)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=dst.parent)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, dst)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+        return dst
+
+    def copy(self, filename: str, src: Path) -> Path:
+        return self.write(filename, src.read_bytes())
+
+    def migrate(self, max_files: Optional[int] = None, sleep_sec: float = 0) -> int:
+        """フラットに置かれているファイルを新しい配置に移す
+
+        Args:
+            max_files: 一度に移すファイル数の上限
+            sleep_sec: 1ファイルごとに待つ秒数．I/Oを占有しないようにする
+        Returns:
+            移したファイル数
+        """
+        n = 0
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if max_files is not None and n >= max_files:
+                    break
+                if not entry.is_file(follow_symlinks=False) or entry.name.startswith("."):
+                    continue
+                src = Path(entry.path)
+                dst = self.sharded_path(entry.name)
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                if not dst.exists():
+                    try:
+                        os.link(src, dst)
+                    except OSError:
+                        tmp = dst.with_name(f".tmp-{dst.name}")
+                        shutil.copy2(src, tmp)
+                        os.replace(tmp, dst)
+                src.unlink()
+                n += 1
+                if sleep_sec > 0:
+                    time.sleep(sleep_sec)
+        self.logger.info("Migrated %d image files", n)
+        return n
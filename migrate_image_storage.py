@@ -0,0 +1,32 @@
+import logging
+import time
+from pathlib import Path
+
+from bsky_gazo_bot.storage import ImageStorage
+
+
+def migrate_image_storage(data_dir: Path, batch_size: int, sleep_sec: float) -> None:
+    """`data/images/`直下の画像をハッシュで振り分けたサブディレクトリに移す．botを止めずに実行してよい"""
+    storage = ImageStorage(data_dir / "images")
+    total = 0
+    while True:
+        n = storage.migrate(max_files=batch_size, sleep_sec=sleep_sec)
+        total += n
+        print(f"migrated {total} files")
+        if n < batch_size:
+            break
+        time.sleep(1)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", type=Path, default=Path("./data"))
+    parser.add_argument("--batch_size", type=int, default=1000)
+    parser.add_argument("--sleep_sec", type=float, default=0.001)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    migrate_image_storage(data_dir=args.data_dir, batch_size=args.batch_size, sleep_sec=args.sleep_sec)
@@ -1,70 +1,36 @@
-import datetime
 import logging
 import os
-import sys
 import time
-from dataclasses import asdict, dataclass
+from dataclasses import asdict
 from pathlib import Path
 from pprint import pformat
 
-from bsky_gazo_bot.cron_scheduler import CronScheduler
 from bsky_gazo_bot.gazo_bot import GazoBot
-
-
-@dataclass
-class RunGazoBotConfig:
-    log_dir: Path
-    data_dir: Path
-    reply_notification_period_sec: int
-    seconds_duplicate_post: int
-    init_session_priod_sec: int
-    backup_priod_sec: int
-    heart_beat_sec: int
-    post_on_start: bool
-
-
-class HeartBeater:
-    def __init__(self, period_sec: int) -> None:
-        self.start = datetime.datetime.now()
-        self.period_sec = period_sec
-
-    def __call__(self) -> bool:
-        res = False
-        now = datetime.datetime.now()
-        if (now - self.start).seconds > self.period_sec:
-            res = True
-            self.start = datetime.datetime.now()
-        return res
+from bsky_gazo_bot.logger import init_logger
+from bsky_gazo_bot.runner import GazoBotRunner, RunGazoBotConfig
 
 
 def run_gazo_bot(config: RunGazoBotConfig, logger: logging.Logger) -> None:
-    logger.info(f"Run gazo bot {pformat(asdict(config))}")
+    logger.info("Run gazo bot %s", pformat(asdict(config)))
     gazo_bot = GazoBot(
         seconds_duplicate_post=config.seconds_duplicate_post,
         data_dir=config.data_dir,
+        prewarm_max_age_sec=config.prewarm_max_age_sec,
+        post_image_count=config.post_image_count,
+        pull_image_count=config.pull_image_count,
         username=os.environ["BSKY_USERNAME"],
         password=os.environ["BSKY_PASSWORD"],
         logger=logger,
     )
-    reply_notification_beater = HeartBeater(config.reply_notification_period_sec)
-    init_session_beater = HeartBeater(config.init_session_priod_sec)
-    backup_beater = HeartBeater(config.backup_priod_sec)
-    cron_scheduler = CronScheduler(target_hours=[13, 19])
+    runner = GazoBotRunner(gazo_bot, config)
     if config.post_on_start:
         gazo_bot.post_image()
     try:
         while True:
-            if init_session_beater():
-                gazo_bot.reset_session()
-            if reply_notification_beater():
-                gazo_bot.reply_nofitications()
-            if backup_beater():
-                gazo_bot.backup_data_dir()
-            if cron_scheduler():
-                gazo_bot.post_image()
+            runner.step()
             time.sleep(config.heart_beat_sec)
     finally:
-        gazo_bot.close()
+        runner.close()
 
 
 if __name__ == "__main__":
@@ -72,15 +38,46 @@ if __name__ == "__main__":
     days_to_seconds = lambda x: x * 24 * 60 * 60
     import argparse
 
+    # デフォルト値は`RunGazoBotConfig`から取る
+    d = RunGazoBotConfig
     parser = argparse.ArgumentParser()
     parser.add_argument("log_dir", type=Path)
     parser.add_argument("--data_dir", type=Path, default=Path("./data"))
-    parser.add_argument("--days_duplicate_post", type=int, default=7)
-    parser.add_argument("--init_session_priod_sec", type=int, default=60 * 60)
-    parser.add_argument("--reply_notification_period_sec", type=int, default=60 * 2)
-    parser.add_argument("--backup_priod_hour", type=int, default=12)
-    parser.add_argument("--heart_beat_sec", type=int, default=5)
+    parser.add_argument("--days_duplicate_post", type=int, default=d.seconds_duplicate_post // days_to_seconds(1))
+    parser.add_argument("--init_session_priod_sec", type=int, default=d.init_session_priod_sec)
+    parser.add_argument("--reply_notification_period_sec", type=int, default=d.reply_notification_period_sec)
+    parser.add_argument("--backup_priod_hour", type=int, default=d.backup_priod_sec // hours_to_seconds(1))
+    parser.add_argument("--heart_beat_sec", type=int, default=d.heart_beat_sec)
     parser.add_argument("--post_on_start", action="store_true")
+    parser.add_argument("--post_hours", type=int, nargs="+", default=list(d.post_hours))
+    parser.add_argument("--post_image_count", type=int, default=d.post_image_count, help="images per post (max 4)")
+    parser.add_argument("--pull_image_count", type=int, default=d.pull_image_count, help="images per pull (max 4)")
+    parser.add_argument("--prewarm_min", type=int, default=d.prewarm_sec // 60, help="0: disable prewarming")
+    parser.add_argument(
+        "--prewarm_max_age_min", type=int, default=d.prewarm_max_age_sec // 60, help="must be > --prewarm_min"
+    )
+    parser.add_argument(
+        "--post_history_retention_days",
+        type=int,
+        default=d.post_history_retention_sec // days_to_seconds(1),
+        help="0: keep all post history",
+    )
+    parser.add_argument("--compact_priod_hour", type=int, default=d.compact_priod_sec // hours_to_seconds(1))
+    parser.add_argument(
+        "--health_scan_period_min",
+        type=int,
+        default=d.health_scan_period_sec // 60,
+        help="wait when no image needs a health scan",
+    )
+    parser.add_argument(
+        "--health_scan_max_files", type=int, default=d.health_scan_max_files, help="per step. 0: disable health scan"
+    )
+    parser.add_argument("--health_scan_mb_per_sec", type=int, default=d.health_scan_bytes_per_sec // (1024 * 1024))
+    parser.add_argument("--health_scan_step_sec", type=float, default=d.health_scan_step_sec)
+    parser.add_argument("--health_rescan_days", type=int, default=d.health_rescan_sec // days_to_seconds(1))
+    parser.add_argument("--log_max_mb", type=int, default=10)
+    parser.add_argument("--log_backup_count", type=int, default=10, help="must be at least 1")
+    parser.add_argument("--log_rotate_hour", type=int, default=24)
 
     args = parser.parse_args()
 
@@ -94,6 +91,18 @@ if __name__ == "__main__":
         backup_priod_sec=hours_to_seconds(args.backup_priod_hour),
         heart_beat_sec=args.heart_beat_sec,
         post_on_start=args.post_on_start,
+        prewarm_sec=args.prewarm_min * 60,
+        post_image_count=args.post_image_count,
+        pull_image_count=args.pull_image_count,
+        post_history_retention_sec=days_to_seconds(args.post_history_retention_days),
+        compact_priod_sec=hours_to_seconds(args.compact_priod_hour),
+        post_hours=tuple(args.post_hours),
+        prewarm_max_age_sec=args.prewarm_max_age_min * 60,
+        health_scan_period_sec=args.health_scan_period_min * 60,
+        health_scan_max_files=args.health_scan_max_files,
+        health_scan_bytes_per_sec=args.health_scan_mb_per_sec * 1024 * 1024,
+        health_scan_step_sec=args.health_scan_step_sec,
+        health_rescan_sec=days_to_seconds(args.health_rescan_days),
     )
 
     config.log_dir.mkdir(parents=True, exist_ok=True)
@@ -102,22 +111,19 @@ if __name__ == "__main__":
 
     # init logger
     logger = logging.getLogger(__name__)
-    [logger.removeHandler(x) for x in logger.handlers]
-
     logger.setLevel(logging.INFO)
-    formatter = logging.Formatter("[%(name)s %(asctime)s] %(message)s")
-
-    stream_handler = logging.StreamHandler(sys.stdout)
-    stream_handler.setFormatter(formatter)
-    logger.addHandler(stream_handler)
-
-    file_handler = logging.FileHandler(log_file)
-    file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+    listener = init_logger(
+        logger,
+        log_file,
+        max_bytes=args.log_max_mb * 1024 * 1024,
+        backup_count=args.log_backup_count,
+        rotate_sec=hours_to_seconds(args.log_rotate_hour),
+    )
 
     try:
         run_gazo_bot(config, logger)
+    except BaseException:
+        logger.exception("Gazo bot stopped")
+        raise
     finally:
-        import traceback
-
-        logger.error(traceback.format_exc())
+        listener.stop()
@@ -0,0 +1,215 @@
+import datetime
+import json
+import logging
+import os
+import time
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from pprint import pformat
+from typing import Any, Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from bsky_gazo_bot.gazo_bot import GazoBot
+from bsky_gazo_bot.logger import init_logger
+from bsky_gazo_bot.runner import GazoBotRunner, RunGazoBotConfig
+
+
+@dataclass
+class AccountConfig:
+    name: str
+    username: str
+    password_env: str
+    backup_dir: Path
+    run_config: RunGazoBotConfig
+
+
+class BotAccount:
+    """1アカウント分のbot．例外はここで握りつぶして他のアカウントに影響させない"""
+
+    def __init__(
+        self,
+        config: AccountConfig,
+        http: requests.Session,
+        executor: ThreadPoolExecutor,
+        init_retry_sec: int,
+        logger: logging.Logger,
+    ) -> None:
+        self.config = config
+        self.http = http
+        self.executor = executor
+        self.init_retry_sec = init_retry_sec
+        self.logger = logger
+        self.runner: Optional[GazoBotRunner] = None
+        self.init_retry_at = datetime.datetime.now()
+        self.future: Optional[Future] = None
+
+    def __init_runner(self) -> None:
+        run_config = self.config.run_config
+        gazo_bot = GazoBot(
+            seconds_duplicate_post=run_config.seconds_duplicate_post,
+            data_dir=run_config.data_dir,
+            prewarm_max_age_sec=run_config.prewarm_max_age_sec,
+            post_image_count=run_config.post_image_count,
+            pull_image_count=run_config.pull_image_count,
+            username=self.config.username,
+            password=os.environ[self.config.password_env],
+            backup_dir=self.config.backup_dir,
+            logger=self.logger,
+            http=self.http,
+            executor=self.executor,
+        )
+        self.runner = GazoBotRunner(gazo_bot, run_config, isolate_tasks=True)
+        if run_config.post_on_start:
+            gazo_bot.post_image()
+
+    def step(self) -> None:
+        try:
+            if self.runner is None:
+                if datetime.datetime.now() < self.init_retry_at:
+                    return
+                self.init_retry_at = datetime.datetime.now() + datetime.timedelta(seconds=self.init_retry_sec)
+                self.__init_runner()
+            assert self.runner
+            self.runner.step()
+        except Exception:
+            self.logger.exception("Failed to run bot %s", self.config.name)
+
+    def submit(self, executor: Executor) -> bool:
+        """`step`を`executor`に投げる．前回の`step`が終わっていなければ飛ばす
+
+        Returns:
+            投げたかどうか
+        """
+        if self.future is not None and not self.future.done():
+            return False
+        self.future = executor.submit(self.step)
+        return True
+
+    def close(self) -> None:
+        if self.runner is None:
+            return
+        try:
+            self.runner.close()
+        except Exception:
+            self.logger.exception("Failed to close bot %s", self.config.name)
+
+
+def load_account_configs(config: Dict[str, Any], log_dir: Path) -> List[AccountConfig]:
+    """設定ファイルの`accounts`の各要素を`defaults`で補う．値の単位は`RunGazoBotConfig`と同じ(秒)
+
+    省略した値は`RunGazoBotConfig`のデフォルト値になる．`backup_dir`を省略すると`$BACKUP_DIR/<name>`になる
+    """
+    res = []
+    for account in config["accounts"]:
+        account = {**config.get("defaults", {}), **account}
+        for key in ["log_dir", "heart_beat_sec"]:
+            assert key not in account, f"`{key}` is shared by all accounts. Set it at the top level, not per account"
+        name = account.pop("name")
+        username = account.pop("username")
+        password_env = account.pop("password_env")
+        backup_dir = account.pop("backup_dir", None)
+        if backup_dir is None:
+            # NOTE: アカウント間でバックアップを上書きし合わないように，`$BACKUP_DIR`を直接使わない
+            assert "BACKUP_DIR" in os.environ, f"Set backup_dir of {name} or $BACKUP_DIR"
+            backup_dir = Path(os.environ["BACKUP_DIR"]) / name
+        account["data_dir"] = Path(account["data_dir"])
+        if "post_hours" in account:
+            account["post_hours"] = tuple(account["post_hours"])
+        run_config = RunGazoBotConfig(log_dir=log_dir, heart_beat_sec=config["heart_beat_sec"], **account)
+        res.append(
+            AccountConfig(
+                name=name,
+                username=username,
+                password_env=password_env,
+                backup_dir=Path(backup_dir),
+                run_config=run_config,
+            )
+        )
+    assert len({x.name for x in res}) == len(res), "Duplicated account name"
+    assert len({x.backup_dir.resolve() for x in res}) == len(res), "Duplicated backup_dir"
+    return res
+
+
+def run_gazo_bot_host(config: Dict[str, Any], log_dir: Path, logger: logging.Logger) -> None:
+    accounts_config = load_account_configs(config, log_dir)
+    logger.info("Run gazo bot host %s", pformat([asdict(x) for x in accounts_config]))
+
+    max_workers = config.get("max_workers", 4)
+    upload_workers = config.get("upload_workers", 4)
+    http = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=max_workers + upload_workers)
+    http.mount("https://", adapter)
+    http.mount("http://", adapter)
+
+    with ThreadPoolExecutor(max_workers, thread_name_prefix="bot") as workers, ThreadPoolExecutor(
+        upload_workers, thread_name_prefix="upload"
+    ) as uploaders:
+        accounts = [
+            BotAccount(
+                x,
+                http=http,
+                executor=uploaders,
+                init_retry_sec=config.get("init_retry_sec", 5 * 60),
+                logger=logger.getChild(x.name),
+            )
+            for x in accounts_config
+        ]
+        try:
+            while True:
+                for account in accounts:
+                    account.submit(workers)
+                time.sleep(config["heart_beat_sec"])
+        finally:
+            for account in accounts:
+                if account.future is not None:
+                    account.future.cancel()
+            for account in accounts:
+                if account.future is not None and not account.future.cancelled():
+                    account.future.result()
+                account.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="複数アカウントのbotを1プロセスで動かす",
+        epilog="""config example:
+{
+  "heart_beat_sec": 5,
+  "max_workers": 4,
+  "defaults": {"reply_notification_period_sec": 120, ...},
+  "accounts": [
+    {"name": "cat", "username": "cat.bsky.social", "password_env": "CAT_PASSWORD",
+     "data_dir": "data/cat", "backup_dir": "backup/cat"},
+    {"name": "dog", "username": "dog.bsky.social", "password_env": "DOG_PASSWORD",
+     "data_dir": "data/dog"}
+  ]
+}
+backup_dir defaults to $BACKUP_DIR/<name>.""",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("log_dir", type=Path)
+    parser.add_argument("config", type=Path, help="json file")
+    args = parser.parse_args()
+
+    config = json.loads(args.config.read_text())
+
+    args.log_dir.mkdir(parents=True, exist_ok=True)
+    log_file = args.log_dir / f"{Path(__file__).stem}.log"
+
+    # init logger
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    listener = init_logger(logger, log_file)
+
+    try:
+        run_gazo_bot_host(config, args.log_dir, logger)
+    except BaseException:
+        logger.exception("Gazo bot host stopped")
+        raise
+    finally:
+        listener.stop()
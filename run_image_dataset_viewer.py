@@ -30,7 +30,7 @@ def get_images_all():
 
 @app.route("/images/<path:path>")
 def get_image(path):
-    return send_file(image_dataset.image_file_dir / path)
+    return send_file(image_dataset.storage.resolve(path))
 
 
 @app.route("/register", methods=["POST"])
@@ -1,21 +1,62 @@
+import datetime
+import gzip
+import io
+import json
+import logging
+import queue
 import tempfile
+import time
+from concurrent.futures import Future
 from pathlib import Path
 
 import numpy as np
 import PIL.Image
 import pytest
 
-from bsky_gazo_bot.db import EmptyPostImageException, ImageDataset
+import run_gazo_bot_host
+from bsky_gazo_bot.cron_scheduler import CronScheduler
+from bsky_gazo_bot.db import (
+    EmptyPostImageException,
+    ImageDataset,
+    ImageHealth,
+    ImagePostHistory,
+    ImagePostStats,
+    InvalidImageException,
+    NotificationRegistry,
+    ReplyDataset,
+)
+from bsky_gazo_bot.logger import (
+    CompressedRotatingFileHandler,
+    NonBlockingQueueHandler,
+    RepeatSamplingFilter,
+    init_logger,
+)
+from bsky_gazo_bot.runner import GazoBotRunner, HeartBeater, RunGazoBotConfig
+from bsky_gazo_bot.storage import ImageStorage
+
+
+def create_example_image() -> bytes:
+    with io.BytesIO() as buffer:
+        PIL.Image.fromarray(np.random.randint(low=0, high=256, size=(128, 128, 3), dtype=np.uint8)).save(buffer, "JPEG")
+        return buffer.getvalue()
 
 
 def test_image_dataset():
     with tempfile.TemporaryDirectory() as data_dir:
         data_dir = Path(data_dir)
-        example_image = PIL.Image.fromarray(
-            np.random.randint(low=0, high=256, size=(128, 128, 3), dtype=np.uint8)
-        ).tobytes()
+        example_image = create_example_image()
         dataset = ImageDataset(data_dir)
 
+        # can reject data which is not an image
+        with pytest.raises(InvalidImageException):
+            dataset.add("post-cid-0", "post-uri-0", 0, example_image[:64])
+        with pytest.raises(InvalidImageException):
+            dataset.add("post-cid-0", "post-uri-0", 0, b"not an image")
+        # truncated body whose header is valid is rejected too
+        with pytest.raises(InvalidImageException):
+            dataset.add("post-cid-0", "post-uri-0", 0, example_image[: len(example_image) // 2])
+        assert not dataset.storage.exists("post-cid-0_0.jpg")
+
         # can add images
         dataset.add("post-cid-1", "post-uri-1", 0, example_image)
         dataset.add("post-cid-2", "post-uri-2", 0, example_image)
@@ -40,3 +81,456 @@ def test_image_dataset():
         # can raises exception when there is no image to be post
         with pytest.raises(EmptyPostImageException):
             dataset.sample(100)
+
+        # post stats are updated with each post
+        stats = {x.image_id: x for x in dataset.session.query(ImagePostStats).all()}
+        assert set(stats) == {1, 3}
+        assert stats[1].post_count + stats[3].post_count == 3
+
+        # old history can be compacted while stats are kept
+        assert dataset.compact_post_history(0) == 3
+        assert len(dataset.get_all_post_history()) == 0
+        with pytest.raises(EmptyPostImageException):
+            dataset.sample(100)
+        dataset.sample()
+
+
+def test_logger():
+    with tempfile.TemporaryDirectory() as log_dir:
+        log_file = Path(log_dir) / "test.log"
+        logger = logging.getLogger("test_logger")
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        listener = init_logger(logger, log_file, max_bytes=1024, backup_count=100, sampling_max_per_window=3)
+        try:
+            # repetitive messages are sampled
+            for i in range(10):
+                logger.info("repeated %d", i)
+            # warnings are not sampled
+            for i in range(5):
+                logger.warning("warned %d", i)
+            # distinct messages rotate the log file
+            for i in range(30):
+                logger.info(f"message {i:04} " + "x" * 64)
+        finally:
+            listener.stop()
+
+        # rotated files are compressed
+        rotated = list(Path(log_dir).glob("test.log.*.gz"))
+        assert len(rotated) > 1
+        records = [json.loads(line) for line in log_file.open()]
+        for file in rotated:
+            with gzip.open(file, "rt") as f:
+                records += [json.loads(line) for line in f]
+        assert len(records) == 38
+        assert len([x for x in records if x["message"].startswith("repeated")]) == 3
+        assert len([x for x in records if x["message"].startswith("warned")]) == 5
+
+
+def test_non_blocking_queue_handler_reports_dropped():
+    log_queue = queue.Queue(2)
+    logger = logging.getLogger("test_non_blocking_queue_handler")
+    logger.propagate = False
+    [logger.removeHandler(x) for x in logger.handlers]
+    logger.addHandler(NonBlockingQueueHandler(log_queue))
+    for i in range(5):
+        logger.warning("message %d", i)
+    assert [x.getMessage() for x in [log_queue.get(), log_queue.get()]] == ["message 0", "message 1"]
+
+    # the number of dropped records is reported once the queue has room
+    logger.warning("message %d", 5)
+    assert [x.getMessage() for x in [log_queue.get(), log_queue.get()]] == [
+        "Dropped 3 log records because the log queue was full",
+        "message 5",
+    ]
+    assert log_queue.empty()
+
+
+def test_rotating_file_handler_requires_backup():
+    with tempfile.TemporaryDirectory() as log_dir:
+        with pytest.raises(AssertionError, match="backup_count"):
+            CompressedRotatingFileHandler(Path(log_dir) / "test.log", max_bytes=1024, backup_count=0)
+
+
+def test_repeat_sampling_filter_evicts_old_keys():
+    sampling_filter = RepeatSamplingFilter(max_per_window=1, max_keys=2)
+    records = [logging.LogRecord("test", logging.INFO, "", 0, f"message {i}", None, None) for i in range(3)]
+    assert all(sampling_filter.filter(x) for x in records)
+    assert list(sampling_filter.counts) == [("test", logging.INFO, "message 1"), ("test", logging.INFO, "message 2")]
+    assert not sampling_filter.filter(records[2])
+
+
+def test_image_storage():
+    with tempfile.TemporaryDirectory() as root:
+        root = Path(root)
+        storage = ImageStorage(root)
+
+        # new files are written into hash-prefixed directories
+        path = storage.write("new.jpg", b"new")
+        assert path.parent.parent.parent == root
+        assert storage.resolve("new.jpg") == path and path.read_bytes() == b"new"
+        with pytest.raises(AssertionError):
+            storage.write("new.jpg", b"new")
+
+        # legacy flat files are readable before and after migration
+        (root / "old.jpg").write_bytes(b"old")
+        assert storage.resolve("old.jpg") == root / "old.jpg"
+        assert storage.migrate() == 1
+        assert storage.resolve("old.jpg") == storage.sharded_path("old.jpg")
+        assert storage.resolve("old.jpg").read_bytes() == b"old"
+        assert not (root / "old.jpg").exists()
+        assert storage.migrate() == 0
+
+        with pytest.raises(ValueError):
+            storage.resolve("../db.sqlite3")
+
+
+def test_image_storage_read_during_migration(monkeypatch):
+    with tempfile.TemporaryDirectory() as root:
+        root = Path(root)
+        storage = ImageStorage(root)
+        (root / "old.jpg").write_bytes(b"old")
+
+        # the file is migrated between resolving the flat path and reading it
+        resolve = storage.resolve
+
+        def resolve_then_migrate(filename):
+            path = resolve(filename)
+            storage.migrate()
+            return path
+
+        monkeypatch.setattr(storage, "resolve", resolve_then_migrate)
+        with pytest.raises(FileNotFoundError):
+            resolve_then_migrate("old.jpg").read_bytes()
+        (root / "old.jpg").write_bytes(b"old")
+        storage.sharded_path("old.jpg").unlink()
+        assert storage.read_bytes("old.jpg") == b"old"
+        assert not (root / "old.jpg").exists()
+
+        # opened files are readable even if they are moved afterwards
+        (root / "another.jpg").write_bytes(b"another")
+        monkeypatch.setattr(storage, "resolve", resolve)
+        with storage.open("another.jpg") as f:
+            storage.migrate()
+            assert f.read() == b"another"
+
+
+def test_backfill_post_stats():
+    with tempfile.TemporaryDirectory() as data_dir:
+        data_dir = Path(data_dir)
+        dataset = ImageDataset(data_dir)
+        for post_date in [datetime.datetime(2023, 1, 1), datetime.datetime(2023, 1, 2)]:
+            dataset.session.add(ImagePostHistory(image_id=1, post_date=post_date))
+        dataset.session.commit()
+
+        # stats are backfilled from existing history on start
+        dataset = ImageDataset(data_dir)
+        stats = dataset.session.query(ImagePostStats).one()
+        assert stats.image_id == 1
+        assert stats.post_count == 2
+        assert stats.last_posted_at == datetime.datetime(2023, 1, 2)
+
+
+def test_cron_scheduler_offset():
+    scheduler = CronScheduler([13, 19])
+    prewarm_scheduler = CronScheduler([13, 19], offset_sec=-300)
+    for x, y in zip(scheduler.buffer, prewarm_scheduler.buffer):
+        assert x - y == datetime.timedelta(seconds=300)
+
+
+def test_sample_many():
+    with tempfile.TemporaryDirectory() as data_dir:
+        data_dir = Path(data_dir)
+        dataset = ImageDataset(data_dir)
+        for i in range(5):
+            image_id = dataset.add(f"post-cid-{i}", f"post-uri-{i}", 0, create_example_image())
+            dataset.register_image(image_id, True)
+
+        # sampled images are distinct and recorded at once
+        images = dataset.sample_many(3)
+        assert len(set(images)) == 3
+        assert len(dataset.get_all_post_history()) == 3
+
+        # not posted images are preferred, and the rest is filled with posted ones
+        images = dataset.sample_many(4)
+        assert len(set(images)) == 4
+        assert len(dataset.get_all_post_history()) == 7
+
+        # choosing images does not record a post until it is posted
+        image_ids = [image_id for image_id, _ in dataset.choose_many(2)]
+        assert len(dataset.get_all_post_history()) == 7
+        dataset.record_posts(image_ids)
+        assert len(dataset.get_all_post_history()) == 9
+
+        # returns fewer images when there are not enough images
+        assert len(dataset.random_sample_many(10)) == 5
+        with pytest.raises(EmptyPostImageException):
+            dataset.sample_many(4, seconds=100)
+
+
+def test_notification_registry():
+    with tempfile.TemporaryDirectory() as data_dir:
+        data_dir = Path(data_dir)
+        ImageDataset(data_dir).add("cid-1", "uri-1", 0, create_example_image())
+        ReplyDataset(data_dir).add("cid-2", "uri-2", "ping", "pong")
+
+        # images and replies already stored are backfilled as processed
+        registry = NotificationRegistry(data_dir)
+        assert registry.filter_unprocessed(["uri-1", "uri-2", "uri-3", "uri-4"]) == ["uri-3", "uri-4"]
+
+        # any outcome is recorded, and is found from the cache without the db
+        registry.add("uri-3", "cid-3", "ignored")
+        registry.session.close()
+        registry.session = None
+        assert registry.filter_unprocessed(["uri-1", "uri-2", "uri-3"]) == []
+
+        # processed notifications are persisted
+        registry = NotificationRegistry(data_dir, cache_size=1)
+        assert registry.filter_unprocessed(["uri-1", "uri-2", "uri-3", "uri-4"]) == ["uri-4"]
+        assert len(registry.cache) == 1
+
+
+def test_scan_health():
+    with tempfile.TemporaryDirectory() as data_dir:
+        data_dir = Path(data_dir)
+        dataset = ImageDataset(data_dir)
+        for i in range(2):
+            image_id = dataset.add(f"post-cid-{i}", f"post-uri-{i}", 0, create_example_image())
+            dataset.register_image(image_id, True)
+
+        # whole image is checked at ingest
+        health = dataset.session.get(ImageHealth, 1)
+        assert (health.ok, health.format, health.width, health.height) == (True, "JPEG", 128, 128)
+        assert health.checked_date is not None
+        assert dataset.scan_health() == (0, 0, 0)
+
+        # file truncated after ingest is detected by the rescan and excluded from sampling
+        path = dataset.storage.resolve("post-cid-0_0.jpg")
+        path.write_bytes(path.read_bytes()[:1024])
+        assert dataset.scan_health(max_files=1, rescan_sec=0)[:2] == (1, 1)
+        assert dataset.scan_health(max_files=1, rescan_sec=0)[:2] == (1, 0)
+        assert dataset.scan_health() == (0, 0, 0)
+
+        # at least one image is checked even if the time budget is used up
+        assert dataset.scan_health(rescan_sec=0, time_budget_sec=0)[0] == 1
+        assert dataset.session.get(ImageHealth, 1).ok is False
+        assert dataset.session.get(ImageHealth, 2).ok is True
+        assert dataset.sample_many(2) == [dataset.storage.resolve("post-cid-1_0.jpg")]
+        assert dataset.random_sample_many(2) == [dataset.storage.resolve("post-cid-1_0.jpg")]
+
+
+def test_heart_beater_long_period():
+    # periods longer than a day fire too
+    beater = HeartBeater(24 * 60 * 60)
+    assert not beater()
+    beater.start -= datetime.timedelta(days=2)
+    assert beater()
+    assert not beater()
+
+
+def test_load_account_configs(monkeypatch):
+    monkeypatch.setenv("BACKUP_DIR", "backup")
+    config = {
+        "heart_beat_sec": 3,
+        "defaults": {"post_image_count": 2, "post_hours": [9]},
+        "accounts": [
+            {"name": "cat", "username": "cat", "password_env": "CAT", "data_dir": "data/cat", "backup_dir": "b/cat"},
+            {"name": "dog", "username": "dog", "password_env": "DOG", "data_dir": "data/dog", "post_image_count": 3},
+        ],
+    }
+    cat, dog = run_gazo_bot_host.load_account_configs(config, Path("log"))
+
+    # defaults are overridden per account, and the rest comes from `RunGazoBotConfig`
+    assert (cat.run_config.post_image_count, dog.run_config.post_image_count) == (2, 3)
+    assert cat.run_config.post_hours == dog.run_config.post_hours == (9,)
+    assert cat.run_config.prewarm_sec == RunGazoBotConfig.prewarm_sec
+    assert cat.run_config.heart_beat_sec == 3
+    assert cat.run_config.log_dir == Path("log")
+
+    # paths are converted
+    assert cat.run_config.data_dir == Path("data/cat")
+    assert cat.backup_dir == Path("b/cat")
+
+    # each account is backed up into its own directory under $BACKUP_DIR by default
+    assert dog.backup_dir == Path("backup/dog")
+    accounts = [{k: v for k, v in x.items() if k != "backup_dir"} for x in config["accounts"]]
+    cat, dog = run_gazo_bot_host.load_account_configs({**config, "accounts": accounts}, Path("log"))
+    assert (cat.backup_dir, dog.backup_dir) == (Path("backup/cat"), Path("backup/dog"))
+    with pytest.raises(AssertionError, match="Duplicated backup_dir"):
+        run_gazo_bot_host.load_account_configs(
+            {**config, "accounts": [{**x, "backup_dir": "b/cat"} for x in accounts]}, Path("log")
+        )
+    monkeypatch.delenv("BACKUP_DIR")
+    with pytest.raises(AssertionError, match="BACKUP_DIR"):
+        run_gazo_bot_host.load_account_configs({**config, "accounts": accounts}, Path("log"))
+
+    # names must be unique
+    with pytest.raises(AssertionError, match="Duplicated"):
+        run_gazo_bot_host.load_account_configs({**config, "accounts": [config["accounts"][0]] * 2}, Path("log"))
+
+    # keys shared by all accounts are rejected
+    for key, value in [("heart_beat_sec", 1), ("log_dir", "log")]:
+        with pytest.raises(AssertionError, match=key):
+            run_gazo_bot_host.load_account_configs({**config, "defaults": {key: value}}, Path("log"))
+
+
+def test_bot_account_step(monkeypatch, caplog):
+    class FakeGazoBot:
+        fail_init = {"cat": 1, "dog": 0}
+
+        def __init__(self, username, **kwargs):
+            if self.fail_init[username] > 0:
+                self.fail_init[username] -= 1
+                raise RuntimeError(f"login {username}")
+            self.username = username
+
+    class FakeRunner:
+        n_steps = {"cat": 0, "dog": 0}
+
+        def __init__(self, gazo_bot, config, isolate_tasks):
+            self.username = gazo_bot.username
+
+        def step(self):
+            self.n_steps[self.username] += 1
+            if self.username == "dog" and self.n_steps["dog"] == 1:
+                raise RuntimeError("step dog")
+
+    monkeypatch.setattr(run_gazo_bot_host, "GazoBot", FakeGazoBot)
+    monkeypatch.setattr(run_gazo_bot_host, "GazoBotRunner", FakeRunner)
+    monkeypatch.setenv("PASSWORD", "password")
+    accounts = [
+        run_gazo_bot_host.BotAccount(
+            run_gazo_bot_host.AccountConfig(
+                name=name,
+                username=name,
+                password_env="PASSWORD",
+                backup_dir=Path("backup") / name,
+                run_config=RunGazoBotConfig(log_dir=Path("log"), data_dir=Path(name)),
+            ),
+            http=None,
+            executor=None,
+            init_retry_sec=60,
+            logger=logging.getLogger(name),
+        )
+        for name in ["cat", "dog"]
+    ]
+    cat, dog = accounts
+
+    # exceptions are logged and do not stop the other account
+    with caplog.at_level(logging.ERROR):
+        for account in accounts:
+            account.step()
+    assert "Failed to run bot cat" in caplog.text
+    assert "Failed to run bot dog" in caplog.text
+    assert cat.runner is None
+    assert FakeRunner.n_steps == {"cat": 0, "dog": 1}
+
+    # failed login is not retried until `init_retry_sec` passes, but steps are retried soon
+    for account in accounts:
+        account.step()
+    assert cat.runner is None
+    assert FakeRunner.n_steps == {"cat": 0, "dog": 2}
+    cat.init_retry_at -= datetime.timedelta(seconds=60)
+    for account in accounts:
+        account.step()
+    assert cat.runner is not None
+    assert FakeRunner.n_steps == {"cat": 1, "dog": 3}
+
+
+def test_runner_isolates_tasks(caplog):
+    class FakeGazoBot:
+        def __init__(self):
+            self.logger = logging.getLogger("test_runner_isolates_tasks")
+            self.calls = []
+
+        def __getattr__(self, name):
+            def task(*args):
+                self.calls.append(name)
+                if name == "reply_nofitications" or (name == "post_image" and self.calls.count(name) == 1):
+                    raise RuntimeError(name)
+
+            task.__name__ = name
+            return task
+
+    config = RunGazoBotConfig(log_dir=Path("log"), data_dir=Path("data"), prewarm_sec=0, health_scan_max_files=0)
+    gazo_bot = FakeGazoBot()
+    runner = GazoBotRunner(gazo_bot, config, isolate_tasks=True)
+    runner.cron_scheduler = lambda: not gazo_bot.calls
+    for beater in [runner.reply_notification_beater, runner.backup_beater]:
+        beater.start -= datetime.timedelta(days=1)
+
+    # a failing task does not stop the following ones, and a failed post is retried on the next step
+    with caplog.at_level(logging.ERROR):
+        runner.step()
+    assert gazo_bot.calls == ["post_image", "reply_nofitications", "backup_data_dir"]
+    assert "Failed to run post_image" in caplog.text
+    assert "Failed to run reply_nofitications" in caplog.text
+    runner.step()
+    runner.step()
+    assert gazo_bot.calls.count("post_image") == 2
+
+    # tasks are not isolated by default
+    with pytest.raises(RuntimeError):
+        GazoBotRunner(FakeGazoBot(), config).step()
+
+
+def test_bot_account_submit():
+    class FakeExecutor:
+        def __init__(self):
+            self.futures = []
+
+        def submit(self, fn):
+            self.futures.append(Future())
+            return self.futures[-1]
+
+    account = run_gazo_bot_host.BotAccount(None, http=None, executor=None, init_retry_sec=60, logger=None)
+    executor = FakeExecutor()
+
+    # busy accounts are skipped until the previous step is done
+    assert account.submit(executor)
+    assert not account.submit(executor)
+    executor.futures[-1].set_result(None)
+    assert account.submit(executor)
+    executor.futures[-1].set_exception(RuntimeError())
+    assert account.submit(executor)
+    assert len(executor.futures) == 3
+
+
+def test_runner_health_scan():
+    class FakeGazoBot:
+        def __init__(self):
+            self.n_images = 5
+            self.calls = 0
+
+        def __getattr__(self, name):
+            # the other periodic tasks do nothing
+            return lambda *args, **kwargs: None
+
+        def scan_image_health(self, max_files, rescan_sec, time_budget_sec):
+            # checks 2 images of 1000 bytes within the time budget
+            n_checked = min(max_files, self.n_images, 2)
+            self.n_images -= n_checked
+            self.calls += 1
+            return n_checked, n_checked * 1000
+
+    config = RunGazoBotConfig(log_dir=Path("log"), data_dir=Path("data"), health_scan_bytes_per_sec=1000)
+    gazo_bot = FakeGazoBot()
+    runner = GazoBotRunner(gazo_bot, config)
+
+    # the scan is throttled by the bytes read
+    runner.step()
+    runner.step()
+    assert gazo_bot.calls == 1
+    assert 1 < runner.health_scan_resume_at - time.monotonic() <= 2
+
+    # the scan continues without waiting for the next period until no image is left
+    for _ in range(3):
+        runner.health_scan_resume_at = 0
+        runner.step()
+    assert (gazo_bot.calls, gazo_bot.n_images) == (4, 0)
+    assert runner.health_scan_resume_at - time.monotonic() > config.health_scan_period_sec - 1
+
+    with pytest.raises(AssertionError, match="health_scan_bytes_per_sec"):
+        GazoBotRunner(
+            gazo_bot, RunGazoBotConfig(log_dir=Path("log"), data_dir=Path("data"), health_scan_bytes_per_sec=0)
+        )